@@ -13,15 +13,197 @@
 # limitations under the License.
 
 import os
+import mmap
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from numpy.random import default_rng
 import paddle
 from paddle.io import Dataset
+import paddle.distributed as dist
 from paddle.io import DataLoader, DistributedBatchSampler
 
 from utils import timer_wrapper
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Rejection sampling gives up after k * _MAX_REJECTION_RATIO draws, so
+# that it terminates when (almost) all candidates are filtered.
+_MAX_REJECTION_RATIO = 10
+
+
+def _rejection_sample(k, num_cand, cand, filter_arr):
+    """
+    Sample up to k elements uniformly with values in filter_arr rejected.
+    Fewer than k elements are returned if too many draws are rejected.
+
+    Args:
+        k (int): Number of sampled elements.
+        num_cand (int): Number of candidates.
+        cand (np.ndarray or None): The int64 candidates. None denotes
+            sampling integers from [0, num_cand).
+        filter_arr (np.ndarray): The sorted int64 array of invalid values.
+    """
+    out = np.empty(k, dtype=np.int64)
+    num_filter = filter_arr.shape[0]
+    i = 0
+    for _ in range(k * _MAX_REJECTION_RATIO):
+        if i == k:
+            break
+        x = np.random.randint(0, num_cand)
+        if cand is not None:
+            x = cand[x]
+        pos = np.searchsorted(filter_arr, x)
+        if pos == num_filter or filter_arr[pos] != x:
+            out[i] = x
+            i += 1
+    return out[:i]
+
+
+# Filters with fewer ids are searched by bisection, larger ones by hashing.
+_HASH_FILTER_MIN_SIZE = 64
+
+
+def _hash_slot(x, mask):
+    """Slot of x in an open-addressed table of size mask + 1.
+    """
+    x = (x ^ (x >> 16)) * 0x45d9f3b
+    x = x ^ (x >> 16)
+    return x & mask
+
+
+def _build_hash_tables(indptr, data, table_indptr, tables):
+    """
+    Insert data[indptr[i]:indptr[i + 1]] into the linear-probing table
+    tables[table_indptr[i]:table_indptr[i + 1]] (power-of-two sized and
+    filled with -1) for every non-empty table.
+    """
+    for i in range(indptr.shape[0] - 1):
+        start = table_indptr[i]
+        mask = table_indptr[i + 1] - start - 1
+        if mask < 0:
+            continue
+        for j in range(indptr[i], indptr[i + 1]):
+            slot = _hash_slot(data[j], mask)
+            while tables[start + slot] != -1:
+                slot = (slot + 1) & mask
+            tables[start + slot] = data[j]
+
+
+def _hash_rejection_sample(k, num_cand, cand, table):
+    """
+    Sample up to k elements uniformly with values in a hash table rejected.
+    Fewer than k elements are returned if too many draws are rejected.
+
+    Args:
+        k (int): Number of sampled elements.
+        num_cand (int): Number of candidates.
+        cand (np.ndarray or None): The int64 candidates. None denotes
+            sampling integers from [0, num_cand).
+        table (np.ndarray): The linear-probing table of invalid values,
+            see _build_hash_tables.
+    """
+    out = np.empty(k, dtype=np.int64)
+    mask = table.shape[0] - 1
+    i = 0
+    for _ in range(k * _MAX_REJECTION_RATIO):
+        if i == k:
+            break
+        x = np.random.randint(0, num_cand)
+        if cand is not None:
+            x = cand[x]
+        slot = _hash_slot(x, mask)
+        while table[slot] != -1 and table[slot] != x:
+            slot = (slot + 1) & mask
+        if table[slot] != x:
+            out[i] = x
+            i += 1
+    return out[:i]
+
+
+def _seed_sampler(seed):
+    """Seed the random state used by the numba samplers, which is
+    per-thread, in the calling thread.
+    """
+    np.random.seed(seed)
+
+
+if njit is not None:
+    _hash_slot = njit(cache=True)(_hash_slot)
+    _build_hash_tables = njit(cache=True)(_build_hash_tables)
+    _hash_rejection_sample = njit(cache=True)(_hash_rejection_sample)
+    _rejection_sample = njit(cache=True)(_rejection_sample)
+    _seed_sampler = njit(cache=True)(_seed_sampler)
+else:
+    _build_hash_tables = None
+    _rejection_sample = None
+    # Without numba no sampler uses the global numpy random state.
+    _seed_sampler = lambda seed: None
+
+
+class NegativePool(object):
+    """
+    Ring buffer of negative samples drawn uniformly from [0, num_cand).
+
+    The buffer holds negatives of pool_batches batches and is split in
+    two halves. Once a half has been read, it is refilled by a background
+    thread, so sampling is hidden behind the consumption of the other half.
+
+    Args:
+        num_cand (int): Number of candidates.
+        shape (tuple): Shape of negative samples per batch.
+        pool_batches (int, optional): Number of batches in the buffer.
+        seed (int, optional): Random seed of the pool.
+    """
+
+    def __init__(self, num_cand, shape, pool_batches=16, seed=None):
+        assert pool_batches % 2 == 0, 'pool_batches should be even!'
+        self._num_cand = num_cand
+        self._shape = tuple(shape)
+        self._half = pool_batches // 2
+        self._rng = default_rng(seed)
+        self._buffer = np.empty(
+            (pool_batches, ) + self._shape, dtype='int64')
+        self._cursor = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # Fill the first half now and the second one in background.
+        self._fill(0)
+        self._futures = [None, self._executor.submit(self._fill, self._half)]
+
+    def match(self, num_cand, shape):
+        """Whether the pool samples negatives for the given setting.
+        """
+        return self._num_cand == num_cand and self._shape == tuple(shape)
+
+    def get(self):
+        """Get negative samples of one batch.
+        """
+        part = self._cursor // self._half
+        if self._futures[part] is not None:
+            # Entering a half: wait until it is filled.
+            self._futures[part].result()
+            self._futures[part] = None
+        neg_ents = self._buffer[self._cursor].copy()
+        self._cursor = (self._cursor + 1) % (2 * self._half)
+        if self._cursor % self._half == 0:
+            # Leaving a half: refill it while the other one is read.
+            self._futures[part] = self._executor.submit(
+                self._fill, part * self._half)
+        return neg_ents
+
+    def close(self):
+        """Stop the background thread without waiting for pending fills.
+        """
+        self._executor.shutdown(wait=False)
+
+    def _fill(self, start):
+        self._buffer[start:start + self._half] = self._rng.integers(
+            self._num_cand, size=(self._half, ) + self._shape)
+
 
 class KGDataset(Dataset):
     """
@@ -30,6 +212,7 @@ class KGDataset(Dataset):
     Args:
         triplets (list of tuples or 2D numpy.ndarray):
             The collection of training triplets (h, r, t) with shape [num_triplets, 3].
+            An int64 np.memmap is read per batch instead of loaded into memory.
         num_ents (int):
             The number of entities in the knowledge graph.
         args (argparse.Namespace):
@@ -41,6 +224,7 @@ class KGDataset(Dataset):
                 'chunk': triplets are divided into X chunks and each chunk shares
                     a group of negative samples sampled from all entities.
             - filter_sample (bool): Whether filter out existing triplets.
+            - seed (int): Random seed for negative sampling.
         filter_dict (dict, optional):
             Dictionary of existing triplets, in the form of
             {'head': {(t, r):set(h)}, 'tail': {(h, r):set(t)}}.
@@ -63,12 +247,24 @@ class KGDataset(Dataset):
         shared_rel_path = shared_path.get(
             'rel', None) if shared_path is not None else None
 
-        self._triplets = triplets
-        self._num_ents = num_ents
+        self._num_triplets = len(triplets)
+        # Only memmaps opened directly on a file (not views) can be reopened.
+        if isinstance(triplets, np.memmap) and triplets.dtype == np.int64 \
+                and isinstance(triplets.base, mmap.mmap):
+            # Rows are read from the file per batch, see _batched_getitem.
+            self._triplets = triplets
+        else:
+            self._triplets = None
+            triplets = np.asarray(triplets, dtype=np.int64)
+            self._h = np.ascontiguousarray(triplets[:, 0])
+            self._r = np.ascontiguousarray(triplets[:, 1])
+            self._t = np.ascontiguousarray(triplets[:, 2])
+        self._num_ents = int(num_ents)
         self._neg_sample_size = args.neg_sample_size
         self._neg_sample_type = args.neg_sample_type
         self._sample_weight = args.weighted_loss
-        if self._sample_weight is True:
+        self._filter_sample = args.filter_sample
+        if self._sample_weight is True or self._filter_sample is True:
             assert filter_dict is not None
             assert 'head' in filter_dict
             assert 'tail' in filter_dict
@@ -76,12 +272,18 @@ class KGDataset(Dataset):
         else:
             self._filter_dict = {'head': None, 'tail': None}
 
-        self._filter_sample = args.filter_sample
-        if self._filter_sample is True:
+        if self._filter_sample is True and self._neg_sample_type == 'chunk':
             raise NotImplementedError('sampling with positive triplets '\
-                'filtered is not implemented!')
+                'filtered is not implemented for chunk negative sampling!')
+        if self._filter_sample is True:
+            self._prepare_filter()
+            if self._sample_weight is False:
+                # Only the flat filter arrays are needed by workers.
+                self._filter_dict = {'head': None, 'tail': None}
 
         self._step = 0
+        self._seed_keys = [args.seed, dist.get_rank()]
+        self.set_seed(self._seed_keys)
 
         self._ent_embedding = None
         self._rel_embedding = None
@@ -90,42 +292,115 @@ class KGDataset(Dataset):
         if shared_rel_path is not None:
             self._rel_embedding = np.load(shared_rel_path, mmap_mode='r+')
 
+    @classmethod
+    def from_memmap(cls,
+                    path,
+                    num_triplets,
+                    num_ents,
+                    args,
+                    filter_dict=None,
+                    shared_path=None):
+        """
+        Create a KGDataset from a raw int64 file of triplets with shape
+        [num_triplets, 3], which is memory-mapped rather than loaded.
+
+        Args:
+            path (str): Path of the triplet file.
+            num_triplets (int): The number of triplets in the file.
+            Others are the same as KGDataset.
+        """
+        triplets = np.memmap(
+            path, dtype=np.int64, mode='r', shape=(num_triplets, 3))
+        return cls(triplets, num_ents, args, filter_dict, shared_path)
+
     def __len__(self):
-        return len(self._triplets)
+        return self._num_triplets
 
     def __getitem__(self, index):
-        h, r, t = self._triplets[index]
+        # Triplets are fetched per batch in _batched_getitem.
+        return index
+
+    def _batched_getitem(self, indices):
+        """Fetch triplets and weights of a batch by slicing.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if self._triplets is not None:
+            # Sorted indices turn random row reads into a forward scan.
+            indices.sort()
+            h, r, t = np.ascontiguousarray(self._triplets[indices].T)
+        else:
+            h, r, t = self._h[indices], self._r[indices], self._t[indices]
         if self._sample_weight:
-            weight = self.create_sample_weight(h, r, t)
+            weights = np.array(
+                [
+                    self.create_sample_weight(*x)
+                    for x in zip(h.tolist(), r.tolist(), t.tolist())
+                ],
+                dtype=np.float32)
         else:
-            weight = -1
-        return h, r, t, weight
+            weights = None
+        return h, r, t, weights
+
+    def set_seed(self, seed_keys):
+        """
+        Set random states used in negative sampling from a list of seed
+        keys, e.g. [seed, rank, worker_id], so that distinct keys never
+        share a random stream.
+        """
+        seed_seq = np.random.SeedSequence(seed_keys)
+        self._rng = default_rng(seed_seq)
+        self._neg_pool = None
+        # The numba random state is per-thread, and the DataLoader may
+        # collate in a thread of its own, so it is seeded in collate_fn.
+        self._sampler_seed = int(seed_seq.generate_state(1)[0])
+        self._sampler_threads = set()
+
+    def worker_init_fn(self, worker_id):
+        """Worker_init_fn to avoid duplicated negatives in workers and
+        reopen memory-mapped triplets in each worker.
+        """
+        self.set_seed(self._seed_keys + [worker_id])
+        if self._triplets is not None:
+            self._triplets = np.memmap(
+                self._triplets.filename,
+                dtype=np.int64,
+                mode='r',
+                offset=self._triplets.offset,
+                shape=self._triplets.shape)
 
     def collate_fn(self, data):
         """Collate_fn to corrupt heads and tails by turns.
         """
+        thread_id = threading.get_ident()
+        if thread_id not in self._sampler_threads:
+            _seed_sampler(self._sampler_seed)
+            self._sampler_threads.add(thread_id)
         self._step = self._step ^ 1
-        if self._step == 0:
-            return self._collate_fn(data, 'head', self._filter_dict['head'])
-        else:
-            return self._collate_fn(data, 'tail', self._filter_dict['tail'])
+        mode = 'head' if self._step == 0 else 'tail'
+        fl_set = self._filter_arr[mode] if self._filter_sample else None
+        return self._collate_fn(data, mode, fl_set)
 
     def _collate_fn(self, data, mode, fl_set):
-        h, r, t, weights = np.array(data).T
+        h, r, t, weights = self._batched_getitem(data)
+        batch_size = h.shape[0]
 
         if self._neg_sample_type == 'batch':
-            neg_size = self._neg_sample_size * h.shape[0]
             reindex_func, all_ents = self.group_index([h, t])
-            neg_ents = self.uniform_sampler(neg_size, all_ents)
+            neg_ents = self.batch_sampler(h, r, t, mode, all_ents, fl_set)
 
         elif self._neg_sample_type == 'full':
-            neg_size = self._neg_sample_size * h.shape[0]
-            neg_ents = self.uniform_sampler(neg_size, self._num_ents)
-            reindex_func, all_ents = self.group_index([h, t, neg_ents])
+            neg_ents = self.batch_sampler(h, r, t, mode, self._num_ents,
+                                          fl_set)
+            if self._ent_embedding is None:
+                # Reindexed on device by group_index_on_device.
+                reindex_func, all_ents = None, None
+            else:
+                reindex_func, all_ents = self.group_index(
+                    [h, t, neg_ents.reshape([-1])])
 
         elif self._neg_sample_type == 'chunk':
-            neg_size = max(h.shape[0], self._neg_sample_size)
-            neg_ents = self.uniform_sampler(neg_size, self._num_ents)
+            neg_size = max(batch_size, self._neg_sample_size)
+            neg_ents = self.pool_sampler(self._num_ents, (neg_size, ))
             reindex_func, all_ents = self.group_index([h, t, neg_ents])
 
         else:
@@ -142,12 +417,10 @@ class KGDataset(Dataset):
         else:
             r_emb = None
 
-        h = reindex_func(h)
-        t = reindex_func(t)
-        neg_ents = reindex_func(neg_ents)
-
-        if weights.sum() < 0:
-            weights = None
+        if reindex_func is not None:
+            h, t, neg_ents = np.split(
+                reindex_func(np.concatenate([h, t, neg_ents.reshape([-1])])),
+                [batch_size, 2 * batch_size])
 
         indexs = (h, r, t, neg_ents, all_ents)
         embeds = (all_ents_emb, r_emb, weights)
@@ -163,6 +436,137 @@ class KGDataset(Dataset):
         weights = np.sqrt(1. / weights)
         return weights
 
+    def batch_sampler(self, h, r, t, mode, cand, fl_set=None):
+        """
+        Sampling negative samples for each triplet in a batch.
+
+        Args:
+            h, r, t (np.ndarray): The triplets in the batch.
+            mode (str): 'head' or 'tail', the entities to corrupt.
+            cand (np.ndarray or int): The list of elements to sample. The int
+                value X denotes sampling integers from [0, X).
+            fl_set (tuple, optional): The prepared filter arrays of existing
+                triplets for the given mode. See `_prepare_filter`.
+        Return:
+            np.ndarray: Negative samples with shape [batch_size, neg_sample_size].
+        """
+        if fl_set is None and np.isscalar(cand):
+            return self.pool_sampler(cand,
+                                     (h.shape[0], self._neg_sample_size))
+
+        if fl_set is None:
+            neg_ents = self._rng.integers(
+                cand.shape[0], size=(h.shape[0], self._neg_sample_size))
+            return cand[neg_ents]
+
+        fl_keys, fl_indptr, fl_data, fl_table_indptr, fl_tables = fl_set
+        ents = t if mode == 'head' else h
+        keys = ents.astype(np.int64) * self._filter_num_rels + r
+        pos = np.searchsorted(fl_keys, keys)
+        # Keys missing from the filter, including relations beyond
+        # _filter_num_rels that would alias another key, filter nothing.
+        found = (pos < fl_keys.shape[0]) & (r < self._filter_num_rels)
+        found[found] = fl_keys[pos[found]] == keys[found]
+        pos[~found] = -1
+        empty_set = fl_data[:0]
+        neg_ents = []
+        for p in pos.tolist():
+            if p < 0:
+                filter_set = empty_set
+            else:
+                filter_set = fl_data[fl_indptr[p]:fl_indptr[p + 1]]
+            if p >= 0 and fl_table_indptr is not None and \
+                    fl_table_indptr[p + 1] > fl_table_indptr[p]:
+                new_e = self.hash_sampler(
+                    self._neg_sample_size, cand,
+                    fl_tables[fl_table_indptr[p]:fl_table_indptr[p + 1]])
+            else:
+                new_e = self.uniform_sampler(
+                    self._neg_sample_size, cand, filter_set, rng=self._rng)
+            if new_e.shape[0] < self._neg_sample_size:
+                new_e = self._complete_sample(new_e, cand, filter_set)
+            neg_ents.append(new_e)
+        return np.stack(neg_ents)
+
+    def _complete_sample(self, new_e, cand, filter_set):
+        """
+        Fill up negatives when rejection sampling gave up, which happens
+        when (almost) all candidates are filtered, e.g. in 'batch' mode.
+        The rest is drawn from the unfiltered candidates directly, or from
+        all candidates if every one of them is filtered.
+        """
+        cand = np.arange(cand) if np.isscalar(cand) else np.asarray(cand)
+        valid = np.setdiff1d(cand, filter_set)
+        if valid.shape[0] == 0:
+            valid = cand
+        rest = self._rng.choice(valid, self._neg_sample_size - new_e.shape[0])
+        return np.concatenate([new_e, rest])
+
+    def pool_sampler(self, num_cand, shape):
+        """
+        Sampling negative samples from [0, num_cand) via NegativePool.
+        The pool is created lazily, so that each DataLoader worker owns
+        its thread and random state.
+        """
+        if self._neg_pool is None or not self._neg_pool.match(num_cand,
+                                                              shape):
+            if self._neg_pool is not None:
+                self._neg_pool.close()
+            self._neg_pool = NegativePool(
+                num_cand, shape, seed=self._rng.integers(2**31))
+        return self._neg_pool.get()
+
+    def _prepare_filter(self):
+        """
+        Convert the filter dictionary {(e, r): ids} of each mode into CSR
+        arrays (keys, indptr, data) once. keys are the sorted packed ints
+        e * num_rels + r, and data[indptr[i]:indptr[i + 1]] holds the sorted
+        ids of keys[i]. Flat arrays are shared by forked workers without
+        copies, unlike a dictionary of small arrays.
+
+        With numba available, filters of at least _HASH_FILTER_MIN_SIZE ids
+        also get an open-addressed hash table (table_indptr, tables), so
+        that rejection takes one probe on average instead of a bisection.
+        """
+        num_rels = 0
+        for mode in ['head', 'tail']:
+            for _, rel in self._filter_dict[mode]:
+                num_rels = max(num_rels, int(rel) + 1)
+        self._filter_num_rels = num_rels
+
+        self._filter_arr = {}
+        for mode in ['head', 'tail']:
+            fl_dict = self._filter_dict[mode]
+            keys = np.array(
+                [int(ent) * num_rels + int(rel) for ent, rel in fl_dict],
+                dtype=np.int64)
+            values = list(fl_dict.values())
+            order = np.argsort(keys)
+            indptr = np.zeros(len(values) + 1, dtype=np.int64)
+            indptr[1:] = np.cumsum([len(values[i]) for i in order])
+            # Ids may be given as sets or arrays.
+            data = np.concatenate([np.empty(0, dtype=np.int64)] + [
+                np.sort(np.fromiter(
+                    values[i], dtype=np.int64, count=len(values[i])))
+                for i in order
+            ])
+
+            table_indptr, tables = None, None
+            if _build_hash_tables is not None:
+                counts = np.diff(indptr)
+                sizes = np.left_shift(
+                    1,
+                    np.ceil(np.log2(np.maximum(2 * counts, 1))).astype(
+                        np.int64))
+                sizes[counts < _HASH_FILTER_MIN_SIZE] = 0
+                table_indptr = np.zeros(len(values) + 1, dtype=np.int64)
+                table_indptr[1:] = np.cumsum(sizes)
+                tables = np.full(table_indptr[-1], -1, dtype=np.int64)
+                _build_hash_tables(indptr, data, table_indptr, tables)
+
+            self._filter_arr[mode] = (keys[order], indptr, data,
+                                      table_indptr, tables)
+
     @staticmethod
     def group_index(data):
         """
@@ -174,12 +578,32 @@ class KGDataset(Dataset):
             np.ndarray: Unique elements in data.
         """
         uniques = np.unique(np.concatenate(data))
-        reindex_dict = dict([(x, i) for i, x in enumerate(uniques)])
-        reindex_func = np.vectorize(lambda x: reindex_dict[x])
+        # uniques is sorted, so the position of each element is its new index.
+        reindex_func = lambda x: np.searchsorted(uniques, x)
         return reindex_func, uniques
 
     @staticmethod
-    def uniform_sampler(k, cand, filter_set=None):
+    def hash_sampler(k, cand, filter_table):
+        """
+        Sampling negative samples uniformly with values in filter_table
+        rejected. Requires numba.
+
+        Args:
+            k (int): Number of sampled elements.
+            cand (list or int): The list of elements to sample. The int
+                value X denotes sampling integers from [0, X).
+            filter_table (np.ndarray): The hash table of invalid values
+                built in _prepare_filter.
+        Return:
+            np.ndarray: Up to k sampled elements.
+        """
+        if np.isscalar(cand):
+            return _hash_rejection_sample(k, int(cand), None, filter_table)
+        cand = np.asarray(cand, dtype=np.int64)
+        return _hash_rejection_sample(k, cand.shape[0], cand, filter_table)
+
+    @staticmethod
+    def uniform_sampler(k, cand, filter_set=None, rng=None):
         """
         Sampling negative samples uniformly.
 
@@ -187,13 +611,26 @@ class KGDataset(Dataset):
             k (int): Number of sampled elements.
             cand (list or int): The list of elements to sample. The int
                 value X denotes sampling integers from [0, X).
-            filter_set (list): The list of invalid int values.
+            filter_set (np.ndarray): The sorted int64 array of invalid values.
+            rng (np.random.Generator, optional): The random generator.
+        Return:
+            np.ndarray: Sampled elements, fewer than k with filter_set
+                given if too many draws are rejected.
         """
-        rng = default_rng()
+        if filter_set is not None and _rejection_sample is not None:
+            if np.isscalar(cand):
+                return _rejection_sample(k, int(cand), None, filter_set)
+            cand = np.asarray(cand, dtype=np.int64)
+            return _rejection_sample(k, cand.shape[0], cand, filter_set)
+
+        if rng is None:
+            rng = default_rng()
         if filter_set is not None:
             new_e_list = []
             new_e_num = 0
-            while new_e_num < k:
+            for _ in range(_MAX_REJECTION_RATIO // 2):
+                if new_e_num >= k:
+                    break
                 new_e = rng.choice(cand, 2 * k, replace=True)
                 mask = np.in1d(new_e, filter_set, invert=True)
                 new_e = new_e[mask]
@@ -205,6 +642,90 @@ class KGDataset(Dataset):
         return new_e
 
 
+def group_index_on_device(h, t, neg_ents):
+    """
+    Reindex entities of a batch on device, the counterpart of
+    KGDataset.group_index for batches returned with all_ents as None.
+
+    Args:
+        h, t (paddle.Tensor): Head and tail entities of the batch.
+        neg_ents (paddle.Tensor): Negative entities of the batch.
+    Return:
+        tuple: Reindexed h, t and neg_ents, and the unique entities.
+    """
+    batch_size = h.shape[0]
+    all_ents, index = paddle.unique(
+        paddle.concat([h, t, neg_ents.reshape([-1])]), return_inverse=True)
+    h, t, neg_ents = paddle.split(index, [batch_size, batch_size, -1])
+    return h, t, neg_ents, all_ents
+
+
+class PrefetchLoader(object):
+    """
+    Wrapper of DataLoader to overlap host-to-device copies with loading.
+
+    Tensors of the next batch, already in pinned memory from the
+    DataLoader, are copied to the current GPU without blocking before the
+    current batch is returned, so the host does not wait for the copy.
+    Copies are issued on the current stream, which orders them with the
+    computation and keeps device memory reuse safe. The pinned tensors
+    of a batch are kept until its copies have finished.
+
+    Args:
+        loader (paddle.io.DataLoader): The DataLoader to wrap.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._dev_id = int(paddle.device.get_device().split(':')[1])
+
+    def __len__(self):
+        return len(self._loader)
+
+    def __iter__(self):
+        batch, host_batch, copied = None, None, None
+        for next_host_batch in self._loader:
+            next_batch = self._to_device(next_host_batch)
+            next_copied = paddle.device.cuda.Event()
+            next_copied.record()
+            if batch is not None:
+                yield batch
+            if copied is not None:
+                # Release the pinned tensors of batch only after its copies.
+                copied.synchronize()
+            batch, host_batch, copied = (next_batch, next_host_batch,
+                                         next_copied)
+        if batch is not None:
+            yield batch
+
+    def _to_device(self, data):
+        if isinstance(data, (list, tuple)):
+            return type(data)(self._to_device(x) for x in data)
+        if isinstance(data, paddle.Tensor):
+            return data.cuda(self._dev_id, blocking=False)
+        return data
+
+
+def test_collate_fn(data):
+    """
+    Collate_fn for test datasets.
+
+    Scalar fields are converted with a single typed np.asarray, and array
+    fields (candidates) are copied into a pre-sized buffer.
+    """
+    fields = []
+    for field in zip(*data):
+        if isinstance(field[0], np.ndarray):
+            out = np.empty(
+                (len(field), ) + field[0].shape, dtype=field[0].dtype)
+            for i, x in enumerate(field):
+                out[i] = x
+        else:
+            out = np.asarray(field)
+        fields.append(out)
+    return fields
+
+
 class TestKGDataset(Dataset):
     """
     Dataset for test triplets in dict format.
@@ -304,7 +825,8 @@ def create_dataloaders(trigraph, args, filter_dict=None, shared_ent_path=None):
         triplets=trigraph.train_triplets,
         num_ents=trigraph.num_ents,
         args=args,
-        filter_dict=filter_dict if args.filter_sample else None,
+        filter_dict=filter_dict
+        if args.filter_sample or args.weighted_loss else None,
         shared_path={'ent': shared_ent_path} if args.mix_cpu_gpu else None)
 
     train_sampler = DistributedBatchSampler(
@@ -317,7 +839,12 @@ def create_dataloaders(trigraph, args, filter_dict=None, shared_ent_path=None):
         dataset=train_dataset,
         batch_sampler=train_sampler,
         num_workers=args.num_workers,
+        use_shared_memory=True,
+        persistent_workers=args.num_workers > 0,
+        worker_init_fn=train_dataset.worker_init_fn,
         collate_fn=train_dataset.collate_fn)
+    if paddle.device.get_device().startswith('gpu'):
+        train_loader = PrefetchLoader(train_loader)
 
     if args.valid:
         if args.data_name == 'wikikg90m':
@@ -328,7 +855,9 @@ def create_dataloaders(trigraph, args, filter_dict=None, shared_ent_path=None):
             valid_dataset = TestKGDataset(trigraph.valid_dict,
                                           trigraph.num_ents)
         valid_loader = DataLoader(
-            dataset=valid_dataset, batch_size=args.test_batch_size)
+            dataset=valid_dataset,
+            batch_size=args.test_batch_size,
+            collate_fn=test_collate_fn)
     else:
         valid_loader = None
 
@@ -340,7 +869,9 @@ def create_dataloaders(trigraph, args, filter_dict=None, shared_ent_path=None):
         else:
             test_dataset = TestKGDataset(trigraph.test_dict, trigraph.num_ents)
         test_loader = DataLoader(
-            dataset=test_dataset, batch_size=args.test_batch_size)
+            dataset=test_dataset,
+            batch_size=args.test_batch_size,
+            collate_fn=test_collate_fn)
     else:
         test_loader = None
 
@@ -25,7 +25,7 @@ import paddle.distributed as dist
 from paddle.optimizer.lr import StepDecay
 
 from dataset.reader import read_trigraph
-from dataset.dataset import create_dataloaders
+from dataset.dataset import create_dataloaders, group_index_on_device
 from models.ke_model import KGEModel
 from models.loss_func import LossFunction
 from utils import set_seed, set_logger, print_log
@@ -156,21 +156,18 @@ def main():
     ts = t_step = time.time()
     step = 1
     stop = False
-    dev_id = int(paddle.device.get_device().split(":")[1])
     for epoch in range(args.num_epoch):
         for indexes, prefetch_embeddings, mode in train_loader:
             h, r, t, neg_ents, all_ents = indexes
             all_ents_emb, rel_emb, weights = prefetch_embeddings
 
-            r = r.cuda(dev_id)
-            if all_ents is not None:
-                all_ents = all_ents.cuda(dev_id)
+            if all_ents is None:
+                h, t, neg_ents, all_ents = group_index_on_device(h, t,
+                                                                 neg_ents)
 
             if rel_emb is not None:
-                rel_emb = rel_emb.cuda(dev_id)
                 rel_emb.stop_gradient = False
             if all_ents_emb is not None:
-                all_ents_emb = all_ents_emb.cuda(dev_id)
                 all_ents_emb.stop_gradient = False
             timer['sample'] += (time.time() - ts)
 
@@ -23,7 +23,7 @@ import numpy as np
 from paddle.optimizer.lr import StepDecay
 
 from dataset.reader import read_trigraph
-from dataset.dataset import create_dataloaders
+from dataset.dataset import create_dataloaders, group_index_on_device
 from models.ke_model import KGEModel
 from models.loss_func import LossFunction
 from utils import set_seed, set_logger, print_log
@@ -109,16 +109,13 @@ def main():
             h, r, t, neg_ents, all_ents = indexes
             all_ents_emb, rel_emb, weights = prefetch_embeddings
 
-            r = r.cuda()
-
-            if all_ents is not None:
-                all_ents = all_ents.cuda()
+            if all_ents is None:
+                h, t, neg_ents, all_ents = group_index_on_device(h, t,
+                                                                 neg_ents)
 
             if rel_emb is not None:
-                rel_emb = rel_emb.cuda()
                 rel_emb.stop_gradient = False
             if all_ents_emb is not None:
-                all_ents_emb = all_ents_emb.cuda()
                 all_ents_emb.stop_gradient = False
 
             timer['sample'] += (time.time() - ts)
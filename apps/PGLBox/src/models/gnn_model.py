@@ -22,8 +22,6 @@ import numpy as np
 import pickle as pkl
 
 import paddle
-import paddle.fluid.layers as L
-import paddle.fluid as F
 import pgl
 from pgl.utils.logger import log
 
@@ -86,6 +84,7 @@ class GNNModel(object):
         self.real_emb_size_list = [self.emb_size] * len(self.total_gpups_slots)
 
         self.loss = None
+        self.node_index = None
 
         predictions = self.forward()
         loss, v_loss = self.loss_func(predictions)
@@ -97,13 +96,8 @@ class GNNModel(object):
             v_loss)
 
         if self.is_predict:
-            if self.config.sage_mode:
-                node_index = paddle.gather(self.nodeid_slot_holder,
-                                           self.final_index)
-            else:
-                node_index = self.nodeid_slot_holder
             model_util.dump_embedding(config, predictions["src_nfeat"],
-                                      node_index)
+                                      self.node_index)
 
     def get_etype_len(self):
         """ get length of etype list """
@@ -134,20 +128,35 @@ class GNNModel(object):
 
             feature = self.gnn_model(self.graph_holders, feature,
                                      self.node_degree)
-            feature = paddle.gather(feature, self.final_index)
+            feature = paddle.index_select(feature, self.final_index, axis=0)
 
-        feature = paddle.reshape(feature, shape=[-1, 2, self.emb_size])
+        if self.is_predict:
+            if self.config.sage_mode:
+                self.node_index = paddle.index_select(
+                    self.nodeid_slot_holder, self.final_index, axis=0)
+            else:
+                self.node_index = self.nodeid_slot_holder
 
-        src_feat = feature[:, 0:1, :]
-        dsts_feat_all = [feature[:, 1:, :]]
-        for neg in range(self.neg_num):
-            dsts_feat_all.append(
-                F.contrib.layers.shuffle_batch(dsts_feat_all[0]))
-        dsts_feat = paddle.concat(dsts_feat_all, axis=1)
+        feature = paddle.reshape(feature, shape=[-1, 2, self.emb_size])
 
-        logits = paddle.matmul(
-            src_feat, dsts_feat,
-            transpose_y=True)  # [batch_size, 1, neg_num+1]
+        src_feat, pos_feat = paddle.split(feature, num_or_sections=2, axis=1)
+        dsts_feat = model_util.sample_dsts_feat(pos_feat, self.neg_num,
+                                                self.emb_size)
+
+        if self.config.use_bf16_matmul:
+            # matmul returns bf16, so the logits are rounded to bf16 before
+            # being cast back to fp32.
+            logits = paddle.matmul(
+                paddle.cast(
+                    src_feat, dtype="bfloat16"),
+                paddle.cast(
+                    dsts_feat, dtype="bfloat16"),
+                transpose_y=True)  # [batch_size, 1, neg_num+1]
+            logits = paddle.cast(logits, dtype="float32")
+        else:
+            logits = paddle.matmul(
+                src_feat, dsts_feat,
+                transpose_y=True)  # [batch_size, 1, neg_num+1]
         logits = paddle.squeeze(logits, axis=[1])
 
         predictions = {}
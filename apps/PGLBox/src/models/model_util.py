@@ -23,7 +23,6 @@ import pickle as pkl
 
 import paddle
 import paddle.fluid as F
-import paddle.fluid.layers as L
 import paddle.static as static
 from paddle.common_ops_import import (
     LayerHelper,
@@ -323,6 +322,29 @@ def dump_embedding(config, nfeat, node_index):
         name=config.dump_node_name)  # for rename
 
 
+def sample_dsts_feat(pos_feat, neg_num, emb_size):
+    """ concat positive features with neg_num in-batch negatives
+
+    Like shuffle_batch, each negative column is a random permutation of
+    the batch, but all columns are drawn and gathered in a single op.
+
+    Args:
+        pos_feat: positive features with shape [batch_size, emb_size]
+            or [batch_size, 1, emb_size].
+    Return:
+        dsts features with shape [batch_size, neg_num + 1, emb_size].
+    """
+    batch_size = paddle.shape(pos_feat)[0]
+    pos_index = paddle.reshape(
+        paddle.arange(
+            batch_size, dtype="int64"), shape=[-1, 1])
+    neg_index = paddle.argsort(
+        paddle.rand(shape=[batch_size, neg_num]), axis=0)
+    dsts_index = paddle.concat([pos_index, neg_index], axis=1)
+    dsts_feat = paddle.gather(pos_feat, paddle.reshape(dsts_index, [-1]))
+    return paddle.reshape(dsts_feat, shape=[-1, neg_num + 1, emb_size])
+
+
 def hcl(config, feature, graph_holders):
     """Hierarchical Contrastive Learning"""
     hcl_logits = []
@@ -333,13 +355,8 @@ def hcl(config, feature, graph_holders):
         neighbor_src_feat = paddle.gather(feature, edges_src)
         neighbor_src_feat = neighbor_src_feat.reshape([-1, 1, config.emb_size])
         neighbor_dst_feat = paddle.gather(feature, edges_dst)
-        neighbor_dst_feat = neighbor_dst_feat.reshape([-1, 1, config.emb_size])
-        neighbor_dsts_feat_all = [neighbor_dst_feat]
-
-        for neg in range(config.neg_num):
-            neighbor_dsts_feat_all.append(
-                F.contrib.layers.shuffle_batch(neighbor_dsts_feat_all[0]))
-        neighbor_dsts_feat = paddle.concat(neighbor_dsts_feat_all, axis=1)
+        neighbor_dsts_feat = sample_dsts_feat(neighbor_dst_feat,
+                                              config.neg_num, config.emb_size)
 
         # [batch_size, 1, neg_num+1]
         logits = paddle.matmul(